@@ -5,14 +5,41 @@ import inspect
 import json
 import logging
 import re
+import string
+import threading
 import urllib.parse
-from collections import Sequence
-from itertools import zip_longest
+from collections import defaultdict
 from pprint import pprint
 
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.WARNING)
 
+_MISSING = object()
+
+# scheme, netloc, path, query, fragment
+_URL_RE = re.compile(
+    r'^(?:([^:/?#]+)://)?[:/]*([^/?#]*)([^?#]*)(?:\?([^#]*))?(?:#(.*))?')
+
+# values formatter() returns as they are, looked up by exact type
+_PASSTHROUGH_TYPES = frozenset({str, bytes, int, float, bool, type(None)})
+
+# characters urllib.parse.quote_plus() leaves as they are
+_UNRESERVED_RE = re.compile(r'[A-Za-z0-9_.~-]*')
+
+# idle keep-alive connections, keyed by (scheme, endpoint, timeout)
+_CONN_POOL = defaultdict(list)
+_CONN_POOL_LOCK = threading.Lock()
+# idle connections kept per key; any released beyond that are closed
+_CONN_POOL_MAXSIZE = 8
+
+# only these may be resent if a pooled connection turns out to be stale,
+# since the server may already have processed the failed attempt
+_IDEMPOTENT_METHODS = frozenset({'GET', 'HEAD', 'OPTIONS', 'PUT', 'DELETE'})
+
+# raised when a pooled connection has been closed by the server meanwhile
+_STALE_CONNECTION_ERRORS = (
+    http.client.RemoteDisconnected, ConnectionResetError, BrokenPipeError)
+
 
 class DeclRESTParams(dict):
     DEFAULTS = {
@@ -26,7 +53,14 @@ class DeclRESTParams(dict):
     DEFAULT_FACTORY = list
 
     def to_base_params(self):
-        return copy.deepcopy(self)
+        return self._fast_clone()
+
+    def _fast_clone(self):
+        # values are lists/dicts of immutables, so one level is deep enough
+        return type(self)({
+            k: v.copy() if isinstance(v, (dict, list)) else v
+            for k, v in self.items()
+        })
 
     def append(self, key, value):
         try:
@@ -40,13 +74,13 @@ class DeclRESTParams(dict):
         self[key] = value
 
     def __getattr__(self, key):
-        if key.startswith('__') and key.endswidth('__'):
+        if key.startswith('__') and key.endswith('__'):
             raise AttributeError
 
         try:
             return self[key]
         except KeyError:
-            raise AttributeError
+            return self.setdefault(key, self._default(key))
 
     def __delattr__(self, key):
         try:
@@ -54,17 +88,22 @@ class DeclRESTParams(dict):
         except KeyError:
             raise AttributeError
 
-    def __getitem__(self, key):
-        try:
-            return super().__getitem__(key)
-        except KeyError:
-            if key in self.DEFAULTS:
-                value = self.DEFAULTS[key]
-            else:
-                value = self.DEFAULT_FACTORY()
+    def _default(self, key):
+        value = self.DEFAULTS.get(key, _MISSING)
+
+        if value is _MISSING:
+            return self.DEFAULT_FACTORY()
+
+        return value.copy() if isinstance(value, (dict, list)) else value
+
+    def __deepcopy__(self, memo):
+        new = type(self)()
+        memo[id(self)] = new
 
-            self[key] = value
-            return value
+        for k, v in self.items():
+            new[k] = copy.deepcopy(v, memo)
+
+        return new
 
     def __repr__(self):
         return f'{type(self).__name__}' \
@@ -82,58 +121,75 @@ class DeclRESTParamsDescriptor:
         self.__func__ = func
         self.declrest_base_params = DeclRESTParams()
         self.instance = None
+        self._sig_params = _signature_params(func)
 
     def to_base_params(self):
         return self.declrest_base_params.to_base_params()
 
     def __get__(self, instance=None, owner=None):
-        base_params = self.to_base_params()
-        return DeclRESTRequest(base_params, self.__func__, instance, owner)
+        # the request shares the descriptor's params; build_params() clones
+        # them before mutating, so there is no need to copy them on every
+        # attribute access
+        return DeclRESTRequest(self.declrest_base_params, self.__func__,
+                               instance, owner, self._sig_params)
 
     def __call__(self, *args, **kwargs):
         return self.__get__()(*args, **kwargs)
 
 
 class DeclRESTRequest:
-    KEY_VALUE_PARAMS = {
-        'query': 'query',
-        'form': 'form',
-        'header': 'headers',
-    }
-
-    def __init__(self,
-                 base_params, params_mutator=None, instance=None, owner=None):
-        self.base_params = base_params
+    KEY_VALUE_PARAMS = (
+        ('query', 'query'),
+        ('form', 'form'),
+        ('header', 'headers'),
+    )
+
+    def __init__(self, base_params, params_mutator=None, instance=None,
+                 owner=None, sig_params=None):
+        # may be shared with the descriptor, so it is never mutated in place
+        self._base_params = base_params
         self.params_mutator = params_mutator
         self.instance = instance
         self.owner = owner
 
+        if sig_params is None:
+            sig_params = ((), ()) if params_mutator is None \
+                else _signature_params(params_mutator)
+
+        self._sig_names, self._sig_defaults = sig_params
+
         if (instance, owner) != (None, None):
             self.params_mutator = params_mutator.__get__(instance, owner)
             self.unbound_params_mutator = params_mutator
         else:
             self.unbound_params_mutator = None
 
+    @property
+    def base_params(self):
+        # a copy, so changing it cannot leak into later calls
+        return self._base_params._fast_clone()
+
     def build_params(self, *args, **kwargs):
         params = self.get_declrest_base_params(*args)
         retmap = None
-        logger.debug(f'declrest_base_params={params}')
+        logger.debug('declrest_base_params=%s', params)
+
+        base_params = self._base_params._fast_clone()
 
         if params is None:
-            params = copy.deepcopy(self.base_params)
+            params = base_params
         else:
-            params = copy.deepcopy(params)
-            params.update(self.base_params)
+            params.update(base_params)
+
+        for source_key, target_key in self.KEY_VALUE_PARAMS:
+            source_value = dict.pop(params, source_key, _MISSING)
 
-        for source_key, target_key in self.KEY_VALUE_PARAMS.items():
-            source_value = params[source_key]
+            if source_value is _MISSING:
+                source_value = params._default(source_key)
 
             if source_value is not None:
                 params[target_key] = dict(source_value)
 
-                if target_key != source_key:
-                    del params[source_key]
-
         if self.params_mutator is not None:
             # TODO: append params to params
             kwargs['params'] = \
@@ -153,34 +209,22 @@ class DeclRESTRequest:
                 raise ValueError(f'params_mutator has returned unsupported type: {new_params}')
 
         endpoint_ = _single(params, 'endpoint')
-        scheme_, netloc_, *_path_components = \
-            urllib.parse.urlsplit(endpoint_, scheme=None)
+        scheme_, netloc_, endpoint_path_ = _split_endpoint(endpoint_)
 
         if scheme_ is None:
-            scheme = params.scheme
-            netloc_ = netloc_ or re.findall(r'^[:/]*([^/]*)', endpoint_)[0]
+            scheme = params.get('scheme', params._default('scheme'))
         else:
-            scheme = scheme_.lower()
+            scheme = scheme_
 
         params.scheme = scheme
-        params.endpoint = type(endpoint_)(netloc_)
+        params.endpoint = netloc_
         params.method = _maybe(params, 'method', 'GET')
-        params.headers = params.headers
         params.body = _maybe(params, 'body')
 
         path_ = _maybe(params, 'path')
 
         if path_ is None:
-            path_, query_, fragment_ = _path_components
-            path_ = path_ or '/'
-
-            if query_:
-                path_ += f'?{query_}'
-
-            if fragment_:
-                path_ += f'#{fragment_}'
-
-            path_ = type(endpoint_)(path_)
+            path_ = endpoint_path_
 
         params.path = path_
         params.timeout = _maybe(params, 'timeout')
@@ -189,15 +233,12 @@ class DeclRESTRequest:
         kwargs.update(params=params)
 
         format_source = self.build_format_source(*args, **kwargs)
-        logger.debug(f'format_source={format_source}')
+        logger.debug('format_source=%s', format_source)
 
         params = self.format_params(params, format_source)
         return params, retmap
 
     def build_format_source(self, *args, params, **kwargs):
-        format_source = dict(params)
-
-        sig_params_dict = {}
         self_, func = None, None
 
         if self.unbound_params_mutator is not None:
@@ -207,70 +248,94 @@ class DeclRESTRequest:
             func = self.params_mutator
 
         if func is None:
-            format_source.update(kwargs)
-            return format_source
-
-        # noinspection PyPep8Naming
-        class None_:
-            pass
+            return {**params, **kwargs}
 
-        sig_params = inspect.signature(func).parameters.items()
-        logger.debug(f'sig_params={sig_params}')
+        logger.debug('sig_params=%s', self._sig_names)
 
         if self_ is None:
             given_args = args
         else:
             given_args = (self_,) + args
 
-        logger.debug(f'given_args={given_args}')
+        logger.debug('given_args=%s', given_args)
 
-        for (k, v), a in zip_longest(sig_params, given_args, fillvalue=None_):
-            if k == 'params':
-                continue
+        n = len(given_args)
+        sig_params_dict = dict(zip(self._sig_names, given_args))
 
-            if a is not None_:
-                sig_params_dict[k] = a
-            elif v.default is not inspect.Parameter.empty:
-                sig_params_dict[k] = v.default
+        for k, default in zip(self._sig_names[n:], self._sig_defaults[n:]):
+            if default is not _MISSING:
+                sig_params_dict[k] = default
 
-        format_source.update(sig_params_dict)
-        format_source.update(kwargs)
-        return format_source
+        return {**params, **sig_params_dict, **kwargs}
 
     def __call__(self, *args, **kwargs):
         params, retmap = self.build_params(*args, **kwargs)
+        logger.debug('params: %s', params)
 
-        logger.debug(f'params: {params}')
-        logger.debug(f'endpoint={params.endpoint}, timeout={params.timeout}')
+        # build_params() always sets these keys, so read them as items and
+        # skip the DeclRESTParams.__getattr__ fallback
+        conn_key = (params['scheme'], params['endpoint'], params['timeout'])
+        logger.debug('endpoint=%s, timeout=%s', conn_key[1], conn_key[2])
 
-        conn = self.create_connection(
-            params.scheme, params.endpoint, params.timeout)
-        # noinspection PyProtectedMember
-        logger.debug(f'{params.method} {params.url} {conn._http_vsn_str}')
+        use_pool = params['method'].upper() in _IDEMPOTENT_METHODS
+        pooled_conn = _acquire_connection(conn_key) if use_pool else None
 
-        for k, v in params.headers.items():
-            logger.debug(f'{k}: {v}')
+        if pooled_conn is not None:
+            conn = pooled_conn
+        else:
+            conn = self.create_connection(*conn_key)
+
+        if logger.isEnabledFor(logging.DEBUG):
+            # noinspection PyProtectedMember
+            logger.debug('%s %s %s',
+                         params['method'], params['url'], conn._http_vsn_str)
+
+            for k, v in params['headers'].items():
+                logger.debug('%s: %s', k, v)
 
-        if params.body:
-            logger.debug('')
-            logger.debug(params.body)
+            if params['body']:
+                logger.debug('')
+                logger.debug(params['body'])
+
+        try:
+            ret = self.send_request(conn, params)
+        except _STALE_CONNECTION_ERRORS:
+            if pooled_conn is None:
+                raise
 
-        conn.request(params.method, params.url, params.body, params.headers)
-        ret = conn.getresponse()
+            logger.debug('pooled connection was closed, reconnecting')
+            conn.close()
+            conn = self.create_connection(*conn_key)
+            ret = self.send_request(conn, params)
 
-        logger.debug(f'retmaps={params.retmap}')
+        response = ret
+        hooks = params.get('retmap', [])
+        logger.debug('retmaps=%s', hooks)
 
-        for hook in reversed(params.retmap):
+        for hook in reversed(hooks):
             ret = hook(ret)
 
         if retmap is not None:
             ret = retmap(ret)
 
+        # HEAD and other bodiless responses never read to the end by
+        # themselves, but there is nothing left on the socket to consume
+        if response.length == 0:
+            response.close()
+
+        # the connection can only be reused once the body has been read;
+        # others never take pooled connections, so theirs is closed instead
+        if response.isclosed():
+            if use_pool:
+                _release_connection(conn_key, conn)
+            else:
+                conn.close()
+
         return ret
 
     def get_cls(self):
         instance, owner = self.instance, self.owner
-        logger.debug(f'instance={instance}, owner={owner}')
+        logger.debug('instance=%s, owner=%s', instance, owner)
 
         if owner is not None:
             return owner
@@ -313,31 +378,50 @@ class DeclRESTRequest:
 
         return conn
 
+    @staticmethod
+    def send_request(conn, params):
+        conn.request(params['method'], params['url'], params['body'],
+                     params['headers'])
+        return conn.getresponse()
+
     @staticmethod
     def formatter(format_source):
+        # format_source is fixed for one pass, so each template (shared by
+        # e.g. a key and a value) is formatted only once
+        cache = {}
+
         # noinspection PyShadowingBuiltins
         def format(obj):
+            if type(obj) in _PASSTHROUGH_TYPES:
+                return obj
+
             if isinstance(obj, DeclFormatString):
-                formatted_str = obj.format_map(format_source)
-                logger.debug(f'format: {obj} -> {formatted_str}')
+                static = obj._get_static()
+
+                if static is not None:
+                    return static
+
+                formatted_str = cache.get(id(obj))
+
+                if formatted_str is None:
+                    formatted_str = obj.format_map(format_source)
+                    cache[id(obj)] = formatted_str
+                    logger.debug('format: %s -> %s', obj, formatted_str)
+
                 return formatted_str
 
-            logger.debug(f'format({repr(obj)})')
+            logger.debug('format(%r)', obj)
 
             if isinstance(obj, str):
                 return obj
 
-            if isinstance(obj, Sequence):
-                return type(obj)(map(lambda o: format(o), obj))
+            if isinstance(obj, (list, tuple)):
+                return type(obj)(map(format, obj))
 
             if isinstance(obj, dict):
-                formatted_dict = copy.deepcopy(obj)
-
-                for item in obj.items():
-                    key, value = map(format, item)
-                    formatted_dict[key] = value
-
-                return formatted_dict
+                # templated keys are replaced, so @header(f('X-{k}'), ...)
+                # sends only the formatted name, not the raw template too
+                return {format(k): format(v) for k, v in obj.items()}
 
             return obj
 
@@ -348,26 +432,29 @@ class DeclRESTRequest:
         _path = format_source['path']
         _splitter = '?' if '?' not in _path else '&'
 
-        formatted_params = copy.deepcopy(params)
+        if _has_format_strings(params):
+            formatted_params = type(params)()
+            fmt = self.formatter(format_source)
 
-        for item in params.items():
-            key, value = map(self.formatter(format_source), item)
-            formatted_params[key] = value
+            for key, value in params.items():
+                formatted_params[fmt(key)] = fmt(value)
+        else:
+            formatted_params = type(params)(params)
 
         url = _single(formatted_params, 'path')
-        _query = formatted_params.query
-        query = urllib.parse.urlencode(_query, doseq=True)
+        _query = formatted_params.get('query', {})
+        query = _urlencode(_query, doseq=True)
 
         if query:
             url += _splitter + query
 
-        body = formatted_params.body
-        _form = formatted_params.form
+        body = formatted_params.get('body')
+        _form = formatted_params.get('form')
 
         if body is None and _form is not None:
             if isinstance(_form, list) or isinstance(_form, tuple) or \
                     isinstance(_form, dict):
-                body = urllib.parse.urlencode(_form)
+                body = _urlencode(_form)
             else:
                 raise NotImplementedError(f'Unknown to encode {type(_form)}')
             # elif isinstance(_body, str) or isinstance(_body, bytes):
@@ -375,7 +462,7 @@ class DeclRESTRequest:
 
         formatted_params.url = url
         formatted_params.body = body
-        formatted_params.headers = dict(formatted_params.headers)
+        formatted_params.headers = dict(formatted_params.get('headers', {}))
 
         return formatted_params
 
@@ -396,28 +483,45 @@ class DeclRESTRequest:
 
 
 class DeclFormatString(str):
-    pass
+    # formatted result of a template without fields, or None if it has any
+    _static = _MISSING
+
+    def _get_static(self):
+        if self._static is _MISSING:
+            # malformed templates are left to fail in format_map()
+            try:
+                has_fields = any(
+                    field is not None
+                    for _, field, _, _ in string.Formatter().parse(self))
+            except ValueError:
+                has_fields = True
+
+            self._static = None if has_fields else self.format_map({})
+
+        return self._static
 
 
 def _maybe(params, key, default=None):
-    value = getattr(params, key, [])
+    value = dict.get(params, key, _MISSING)
+
+    if value is _MISSING:
+        return default
 
-    if not isinstance(value, list) and not isinstance(value, tuple):
+    if type(value) is not list and type(value) is not tuple:
         return value
 
-    if len(value) > 1:
+    n = len(value)
+
+    if n > 1:
         raise ValueError(f'{key} requires 1 parameter but got {value}')
 
-    try:
-        return value[0]
-    except IndexError:
-        return default
+    return value[0] if n == 1 else default
 
 
 def _single(params, key):
-    value = getattr(params, key, [])
+    value = dict.get(params, key, [])
 
-    if not isinstance(value, list) and not isinstance(value, tuple):
+    if type(value) is not list and type(value) is not tuple:
         return value
 
     if len(value) != 1:
@@ -426,6 +530,79 @@ def _single(params, key):
     return value[0]
 
 
+@functools.lru_cache(maxsize=256, typed=True)
+def _split_endpoint(endpoint):
+    # endpoints are mostly decorator constants, so each is parsed only once;
+    # the pieces keep the endpoint's type and are shared by every request
+    scheme, netloc, path, query, fragment = _URL_RE.match(endpoint).groups()
+    path = path or '/'
+
+    if query:
+        path += f'?{query}'
+
+    if fragment:
+        path += f'#{fragment}'
+
+    return scheme and scheme.lower(), type(endpoint)(netloc), \
+        type(endpoint)(path)
+
+
+def _acquire_connection(key):
+    with _CONN_POOL_LOCK:
+        conns = _CONN_POOL.get(key)
+        return conns.pop() if conns else None
+
+
+def _release_connection(key, conn):
+    with _CONN_POOL_LOCK:
+        conns = _CONN_POOL[key]
+        if len(conns) < _CONN_POOL_MAXSIZE:
+            conns.append(conn)
+            return
+    conn.close()
+
+
+def _quote_plus(s):
+    return s if _UNRESERVED_RE.fullmatch(s) else urllib.parse.quote_plus(s)
+
+
+def _urlencode(query, doseq=False):
+    # flat {str: str} dicts encode the same with or without doseq
+    if type(query) is dict and all(
+            type(k) is str and type(v) is str for k, v in query.items()):
+        return '&'.join(
+            f'{_quote_plus(k)}={_quote_plus(v)}' for k, v in query.items())
+
+    return urllib.parse.urlencode(query, doseq=doseq)
+
+
+def _has_format_strings(obj):
+    if isinstance(obj, DeclFormatString):
+        return True
+
+    if isinstance(obj, (list, tuple)):
+        return any(map(_has_format_strings, obj))
+
+    if isinstance(obj, dict):
+        return any(map(_has_format_strings, obj.keys())) or \
+               any(map(_has_format_strings, obj.values()))
+
+    return False
+
+
+def _signature_params(func):
+    # inspect.signature() is slow, so it is resolved once per function
+    func = getattr(func, '__func__', func)
+    sig_params = [
+        (k, _MISSING if v.default is inspect.Parameter.empty else v.default)
+        for k, v in inspect.signature(func).parameters.items()
+        if k != 'params'
+    ]
+    names = tuple(k for k, _ in sig_params)
+    defaults = tuple(default for _, default in sig_params)
+    return names, defaults
+
+
 # decorator
 def _add_param(obj, **kwargs):
     if isinstance(obj, DeclRESTParamsDescriptor):
@@ -447,7 +624,7 @@ def _add_param(obj, **kwargs):
 def _composite(*args):
     # args: [(fn, args, kwargs), ...]
     def argmap(arg):
-        if isinstance(arg, Sequence):
+        if isinstance(arg, (list, tuple)):
             len_ = len(arg)
             if len_ > 3:
                 raise ValueError(f'Invalid arg {arg} to _composite')
@@ -568,8 +745,10 @@ def json_decode():
 
 def findall(regex, flags=0):
     """ret = re.findall(regex, ret)"""
+    pattern = re.compile(regex, flags)
+
     def decorator(obj):
-        return _add_param(obj, retmap=lambda r: re.findall(regex, r, flags))
+        return _add_param(obj, retmap=pattern.findall)
 
     return decorator
 